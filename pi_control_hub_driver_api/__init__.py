@@ -18,19 +18,71 @@ __version__ = '0.0.1'
 __author__ = 'Thomas Bonk'
 __author_email__ = 'thomas@meandmymac.de'
 
-from abc import ABC, abstractmethod, abstractproperty
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Tuple
+from functools import lru_cache
+from importlib.metadata import EntryPoint, entry_points
+import logging
+import re
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 from uuid import UUID
 
-import pkg_resources
+
+_logger = logging.getLogger(__name__)
+
+
+class _SlotAlias(object):
+    """Descriptor that exposes a slot of the owning class under a second name. It is
+    used to keep the former private attribute names of the API classes working for
+    driver implementations. Access goes directly to the slot of the owning class, so
+    it isn't affected by subclasses that override the public attribute."""
+
+    __slots__ = ('_slot_name', '_slot')
+
+    def __init__(self, slot_name: str):
+        self._slot_name = slot_name
+        self._slot = None
+
+    def __set_name__(self, owner, name):
+        self._slot = owner.__dict__[self._slot_name]
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return self._slot.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self._slot.__set__(instance, value)
 
 
 class DeviceCommand(ABC):
     """This abstract class is the base for all commands of a device. Inherit
     this class and implement the `execute` method in your implementation.
+
+    The attributes are stored in `__slots__`, so a class can't inherit from both
+    `DeviceCommand` and another class with non-empty `__slots__`, e.g. `DeviceInfo`.
+
+    Attributes
+    ----------
+    id : int
+        The command ID.
+    title : str
+        The command title.
+    icon : bytes
+        The command icon.
     """
 
+    __slots__ = ('id', 'title', 'icon')
+
+    _ICON_POOL_MIN_SIZE = 256
+    _ICON_POOL_MAX_ENTRIES = 128
+    _icon_pool: 'OrderedDict[bytes, bytes]' = OrderedDict()
+    _icon_pool_lock = Lock()
+
     def __init__(self, cmd_id: int, title: str, icon: bytes):
         """Creates a device command with the given data.
 
@@ -45,22 +97,36 @@ class DeviceCommand(ABC):
         """
         self._id = cmd_id
         self._title = title
-        self._icon = icon
+        self._icon = self._pool_icon(icon)
 
-    @property
-    def id(self) -> int:
-        """Getter for the command ID."""
-        return self._id
+    _id = _SlotAlias('id')
+    _title = _SlotAlias('title')
+    _icon = _SlotAlias('icon')
 
-    @property
-    def title(self) -> str:
-        """Getter for the command title."""
-        return self._title
+    @classmethod
+    def _pool_icon(cls, icon: bytes) -> bytes:
+        """Return a shared instance of the given icon, so that commands with equal
+        icons reference the same bytes object. Small icons are not pooled. The pool
+        keeps the most recently used icons only.
+        """
+        if not isinstance(icon, bytes) or len(icon) <= cls._ICON_POOL_MIN_SIZE:
+            return icon
+        pool = DeviceCommand._icon_pool
+        with DeviceCommand._icon_pool_lock:
+            pooled_icon = pool.get(icon)
+            if pooled_icon is not None:
+                pool.move_to_end(icon)
+                return pooled_icon
+            pool[icon] = icon
+            if len(pool) > cls._ICON_POOL_MAX_ENTRIES:
+                pool.popitem(last=False)
+        return icon
 
-    @property
-    def icon(self) -> bytes:
-        """Getter for the command icon."""
-        return self._icon
+    @staticmethod
+    def clear_icon_pool():
+        """Release all icons that are held by the shared icon pool."""
+        with DeviceCommand._icon_pool_lock:
+            DeviceCommand._icon_pool.clear()
 
     @abstractmethod
     async def execute(self):
@@ -74,29 +140,61 @@ class DeviceCommand(ABC):
 
 
 class DeviceInfo(object):
-    """This class is used to provide information for a device. It can be inherited."""
+    """This class is used to provide information for a device. It can be inherited.
+
+    The attributes are stored in `__slots__`, so a class can't inherit from both
+    `DeviceInfo` and another class with non-empty `__slots__`, e.g. `DeviceCommand`.
+
+    Attributes
+    ----------
+    name : str
+        The device name.
+    device_id : str
+        The device ID.
+    """
+
+    __slots__ = ('name', 'device_id')
 
     def __init__(self, name: str, device_id: str):
         self._name = name
         self._id = device_id
 
-    @property
-    def name(self) -> str:
-        """The device name."""
-        return self._name
+    _name = _SlotAlias('name')
+    _id = _SlotAlias('device_id')
 
-    @property
-    def device_id(self) -> str:
-        """The device ID."""
-        return self._id
+
+class _SortedCommandIndex(object):
+    """Command index for small command sets. The commands are kept sorted by their
+    ID and are looked up with a binary search."""
+
+    __slots__ = ('_ids', '_commands')
+
+    def __init__(self, commands_by_id: Dict[int, DeviceCommand]):
+        self._ids = sorted(commands_by_id)
+        self._commands = [commands_by_id[cmd_id] for cmd_id in self._ids]
+
+    def get(self, cmd_id: int) -> Optional[DeviceCommand]:
+        """Return the command with the given ID or None if there is no such command."""
+        try:
+            i = bisect_left(self._ids, cmd_id)
+        except TypeError:
+            return None
+        if i < len(self._ids) and self._ids[i] == cmd_id:
+            return self._commands[i]
+        return None
 
 
 class DeviceDriver(ABC):
     """This is the abstract class that needs to be inherited in order to communicate
     with a device."""
 
+    _SORTED_COMMAND_INDEX_MAX_SIZE = 16
+
+    _command_index: Optional[Union[Dict[int, DeviceCommand], _SortedCommandIndex]] = None
+
     def __init__(self, device_info: DeviceInfo):
         self._device_info = device_info
+        self._command_index = None
 
     @property
     def name(self) -> str:
@@ -140,10 +238,50 @@ class DeviceDriver(ABC):
 
         `DeviceDriverException` in case of an other error.
         """
-        result = list(filter(lambda c: c.id == cmd_id, self.get_commands()))
-        if result.count() > 0:
-            return result[0]
-        raise CommandNotFoundException(self.name, cmd_id)
+        cmd = (await self._get_command_index()).get(cmd_id)
+        if cmd is None:
+            raise CommandNotFoundException(self.name, cmd_id)
+        return cmd
+
+    def invalidate_command_cache(self):
+        """Discard the cached command index. Drivers whose command list changes
+        at runtime must call this method after the commands have changed.
+        """
+        self._command_index = None
+
+    async def _get_command_index(self) -> Union[Dict[int, DeviceCommand], _SortedCommandIndex]:
+        """Return the commands of this device indexed by their ID. The index is
+        built on first use from `get_commands`; if several commands share an ID,
+        the first one wins.
+        """
+        if self._command_index is None:
+            self._command_index = self._build_command_index(await self.get_commands())
+        return self._command_index
+
+    @classmethod
+    def _build_command_index(cls, commands: List[DeviceCommand]) -> Union[Dict[int, DeviceCommand], _SortedCommandIndex]:
+        """Build the command index for the given commands. The sorted index is only used
+        for small command sets with integer IDs; all other command sets are kept in a
+        dictionary. Both index types return None for unknown IDs.
+
+        >>> from enum import Enum
+        >>> from types import SimpleNamespace
+        >>> Cmd = Enum('Cmd', 'UP DOWN')
+        >>> index = DeviceDriver._build_command_index([SimpleNamespace(id=Cmd.UP), SimpleNamespace(id=Cmd.DOWN)])
+        >>> type(index).__name__, index.get(Cmd.DOWN).id, index.get(None)
+        ('dict', <Cmd.DOWN: 2>, None)
+        >>> index = DeviceDriver._build_command_index([SimpleNamespace(id=3, title='a'), SimpleNamespace(id=1, title='b'),
+        ...                                            SimpleNamespace(id=3, title='c')])
+        >>> type(index).__name__, index.get(3).title, index.get(2), index.get(None), index.get('3')
+        ('_SortedCommandIndex', 'a', None, None, None)
+        """
+        commands_by_id: Dict[int, DeviceCommand] = {}
+        for c in commands:
+            commands_by_id.setdefault(c.id, c)
+        if (len(commands_by_id) < cls._SORTED_COMMAND_INDEX_MAX_SIZE
+                and all(isinstance(cmd_id, int) for cmd_id in commands_by_id)):
+            return _SortedCommandIndex(commands_by_id)
+        return commands_by_id
 
     @property
     @abstractmethod
@@ -222,11 +360,6 @@ class DeviceDriverDescriptor(ABC):
         store and read their configurations."""
         DeviceDriverDescriptor._config_path = config_path
 
-    @staticmethod
-    def set_ir_gpio_in(gpio_pin: int):
-        """GPIO pin where a IR receiver is connected to"""
-        DeviceDriverDescriptor._config_path = config_path
-
     @staticmethod
     def get_config_path() -> str:
         """The config path where device drivers can store and read their configurations."""
@@ -262,6 +395,7 @@ class DeviceDriverDescriptor(ABC):
         self._driver_id = driver_id
         self._display_name = display_name
         self._description = description
+        self._requires_authentication: Optional[bool] = None
 
     @property
     def driver_id(self) -> UUID:
@@ -283,17 +417,30 @@ class DeviceDriverDescriptor(ABC):
         """Returns a list with the available device instances."""
 
     @property
-    @abstractproperty
+    @abstractmethod
     def authentication_method(self) -> AuthenticationMethod:
         """The authentication method that is required when pairing a device."""
 
     @property
     def requires_authentication(self) -> bool:
-        """This flag determines whether an authentication is required when pairing a device."""
-        return self.authentication_method != AuthenticationMethod.NONE
+        """This flag determines whether an authentication is required when pairing a device.
+        The value is determined on first access and cached afterwards; call
+        `invalidate_authentication_cache` if `authentication_method` changes."""
+        requires_authentication = getattr(self, '_requires_authentication', None)
+        if requires_authentication is None:
+            requires_authentication = self.authentication_method != AuthenticationMethod.NONE
+            self._requires_authentication = requires_authentication
+        return requires_authentication
+
+    def invalidate_authentication_cache(self):
+        """Discard the cached `requires_authentication` flag. Descriptors whose
+        authentication method depends on their configuration must call this method
+        after the configuration has changed.
+        """
+        self._requires_authentication = None
 
     @property
-    @abstractproperty
+    @abstractmethod
     def requires_pairing(self) -> bool:
         """This flag determines whether pairing is required to communicate with this device."""
 
@@ -367,35 +514,138 @@ class CommandNotFoundException(DeviceDriverException):
     """This exception is thrown if a command is not found."""
 
     def __init__(self, device_driver_name: str, command_id: int):
-        DeviceDriverException.__init__(self, f"The device '{device_driver_name}' has no command with id '{command_id}'")
+        DeviceDriverException.__init__(self, None)
+        self._device_driver_name = device_driver_name
+        self._command_id = command_id
+
+    def __str__(self) -> str:
+        if self._message is None:
+            self._message = f"The device '{self._device_driver_name}' has no command with id '{self._command_id}'"
+        return self._message
 
 class DeviceCommandException(DeviceDriverException):
     """This exception is thrown if an error occurs during command execution."""
 
     def __init__(self, command: DeviceCommand, device_driver_name: str = None):
-        if device_driver_name:
-            DeviceDriverException.__init__(self, f"Error while executing the command '{command.title}' (id = {command.id}) for device '{device_driver_name}'.")
-        else:
-            DeviceDriverException.__init__(self, f"Error while executing the command '{command.title}' (id = {command.id}).")
+        DeviceDriverException.__init__(self, None)
+        self._command = command
+        self._device_driver_name = device_driver_name
+
+    def __str__(self) -> str:
+        if self._message is None:
+            if self._device_driver_name:
+                self._message = f"Error while executing the command '{self._command.title}' (id = {self._command.id}) for device '{self._device_driver_name}'."
+            else:
+                self._message = f"Error while executing the command '{self._command.title}' (id = {self._command.id})."
+        return self._message
 
 
-def installed_drivers(driver_name_prefix: str = 'pi-control-hub-driver-') -> List[DeviceDriverDescriptor]:
+_PACKAGE_NAME_SEPARATORS = re.compile(r'[-_.]+')
+_MAX_DRIVER_LOAD_WORKERS = 8
+
+
+@lru_cache(maxsize=None)
+def _discover_entry_points(driver_name_prefix: str) -> Tuple[Tuple[str, EntryPoint], ...]:
+    """Look up the descriptor entry points of the installed PiControl Hub drivers.
+    The result is cached per prefix.
+
+    Parameters
+    ----------
+    `driver_name_prefix`: `str`
+        Prefix of the package names of drivers packages.
+
+    Returns
+    -------
+    `Tuple[Tuple[str, EntryPoint], ...]`: Tuples of the normalized package name and the
+    descriptor entry point"""
+
+    normalize = _PACKAGE_NAME_SEPARATORS.sub
+    prefix_length = len(driver_name_prefix)
+    keyed_entry_points = (
+        (normalize('-', entry_point.dist.name).lower(), entry_point)
+        for entry_point in entry_points(group='pi_control_hub_driver', name='driver_descriptor')
+        if entry_point.dist is not None)
+    return tuple(
+        (package_key, entry_point) for package_key, entry_point in keyed_entry_points
+        if package_key[:prefix_length] == driver_name_prefix and package_key != 'pi-control-hub-driver-api')
+
+
+_driver_descriptor_factories: Dict[EntryPoint, Callable[[], DeviceDriverDescriptor]] = {}
+_failed_driver_entry_points: Set[EntryPoint] = set()
+
+
+def installed_drivers(driver_name_prefix: str = 'pi-control-hub-driver-',
+                      parallel_load: bool = True) -> List[DeviceDriverDescriptor]:
     """This function returns a list of names of installed PiControl drivers.
 
+    The scan of the installed packages and the loaded drivers are cached; drivers that
+    fail to load are logged once and skipped. Call `clear_driver_cache()` to rescan
+    after drivers have been installed or removed.
+
+    Driver packages that haven't been loaded yet are imported on worker threads, so
+    their imports should be thread-safe. A driver whose import fails on a worker thread,
+    e.g. because it installs a signal handler, is imported again on the calling thread.
+
     Parameters
     ----------
     `driver_name_prefix`: `str`
         Prefix of the package names of drivers packages.
+    `parallel_load`: `bool`
+        Flag that determines whether drivers are imported on worker threads. If false,
+        all drivers are imported on the calling thread.
 
     Returns
     -------
     `List[DeviceDriverDescriptor]`: List of installed PiControl Hub drivers"""
 
-    driver_descriptors = []
-    for package in pkg_resources.working_set:
-        if package.key.startswith(driver_name_prefix) and not package.key == 'pi-control-hub-driver-api':
-            entry_map = package.get_entry_map()
-            entry_point_meta = entry_map["pi_control_hub_driver"]["driver_descriptor"]
-            entry_point = entry_point_meta.load()
-            driver_descriptors.append(entry_point())
-    return driver_descriptors
+    driver_entry_points = _discover_entry_points(driver_name_prefix)
+    pending_entry_points = [
+        (package_key, entry_point) for package_key, entry_point in driver_entry_points
+        if entry_point not in _driver_descriptor_factories and entry_point not in _failed_driver_entry_points]
+    if pending_entry_points:
+        _load_driver_descriptors(pending_entry_points, parallel_load)
+    return [
+        _driver_descriptor_factories[entry_point]() for _, entry_point in driver_entry_points
+        if entry_point in _driver_descriptor_factories]
+
+
+def _load_driver_descriptors(driver_entry_points: List[Tuple[str, EntryPoint]], parallel_load: bool):
+    """Load the driver descriptor factories of the given entry points and cache them.
+    Entry points that can't be loaded are logged and remembered as failed, so that a
+    broken driver doesn't prevent others from loading."""
+
+    if parallel_load and len(driver_entry_points) > 1:
+        with ThreadPoolExecutor(max_workers=min(_MAX_DRIVER_LOAD_WORKERS, len(driver_entry_points))) as executor:
+            factories = list(executor.map(lambda item: _try_load_driver_descriptor(*item), driver_entry_points))
+    else:
+        factories = [None] * len(driver_entry_points)
+
+    for (package_key, entry_point), factory in zip(driver_entry_points, factories):
+        if factory is None:
+            try:
+                factory = entry_point.load()
+            except Exception:
+                _logger.exception("Failed to load the driver descriptor of package '%s'", package_key)
+                _failed_driver_entry_points.add(entry_point)
+                continue
+        _driver_descriptor_factories[entry_point] = factory
+
+
+def _try_load_driver_descriptor(package_key: str, entry_point: EntryPoint) -> Optional[Callable[[], DeviceDriverDescriptor]]:
+    """Load the driver descriptor factory of the given entry point on a worker thread.
+    Errors result in None, so that the driver is loaded again on the calling thread."""
+    try:
+        return entry_point.load()
+    except Exception:
+        _logger.debug("Failed to load the driver descriptor of package '%s' on a worker thread", package_key,
+                      exc_info=True)
+        return None
+
+
+def clear_driver_cache():
+    """Clear the cached driver discovery, the cached descriptor factories and the
+    drivers that failed to load. Call this function to rescan after drivers have been
+    installed or removed."""
+    _discover_entry_points.cache_clear()
+    _driver_descriptor_factories.clear()
+    _failed_driver_entry_points.clear()
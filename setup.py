@@ -16,25 +16,4 @@
 
 from setuptools import setup
 
-from pi_control_hub_driver_api import __version__, __author__, __author_email__
-
-setup(
-    name='pi_control_hub_driver_api',
-    version=__version__,
-    description='Base API for PiControl Hub drivers.',
-    url='https://github.com/PiControl/pi_control_hub_driver_api',
-    author=__author__,
-    author_email=__author_email__,
-    license='Apache 2.0',
-    packages=['pi_control_hub_driver_api'],
-    install_requires=[
-        'setuptools>=69.2.0',
-    ],
-    classifiers=[
-        'Development Status :: 3 - Alpha',
-        'Intended Audience :: Developers',
-        'License :: OSI Approved :: Apache Software License',
-        'Operating System :: POSIX',
-        'Programming Language :: Python :: 3',
-    ],
-)
+setup()